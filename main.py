@@ -2,11 +2,15 @@
 import pandas as pd
 import sys
 import os
+import atexit
+import json
+import logging
+import random
+import threading
 from pathlib import Path
 import time
 import httpx
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
-import webbrowser
+from cachetools import TTLCache
 
 # -------------------- 路径配置必须放在最前面 --------------------
 # 获取当前文件所在目录
@@ -16,8 +20,18 @@ current_dir = Path(__file__).parent
 st.set_page_config(page_title="韶关AI旅游助手", layout="wide")
 
 # -------------------- 初始化设置 --------------------
-print("[DEBUG] 当前工作目录:", os.getcwd())
-print("[DEBUG] 当前文件目录:", current_dir)
+# 设置 APP_DEBUG 环境变量后才输出调试日志。只调整本应用的 logger，不动 root logger，
+# 否则 hpack 等库会在 DEBUG 级别把完整请求头（含 API 密钥）写进日志
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG if os.getenv("APP_DEBUG") else logging.WARNING)
+if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+    logger.addHandler(handler)
+    logger.propagate = False
+
+logger.debug("当前工作目录: %s", os.getcwd())
+logger.debug("当前文件目录: %s", current_dir)
 
 # 构建数据文件路径
 data_dir = current_dir / "data"
@@ -25,20 +39,29 @@ attractions_path = data_dir / "sg_attractions_cleaned.csv"
 food_path = data_dir / "sg_food_cleaned.csv"
 culture_path = data_dir / "sg_culture_cleaned.csv"
 
-print("[DEBUG] 景点文件路径:", attractions_path)
-print("[DEBUG] 美食文件路径:", food_path)
-print("[DEBUG] 文化文件路径:", culture_path)
+logger.debug("景点文件路径: %s", attractions_path)
+logger.debug("美食文件路径: %s", food_path)
+logger.debug("文化文件路径: %s", culture_path)
 
 # -------------------- 环境变量处理 --------------------
-# 在 Streamlit Cloud 上只使用 secrets
-print("[DEBUG] 尝试获取 DeepSeek API 密钥...")
-deepseek_api_key = st.secrets.get("DEEPSEEK_KEY", None)
+# 优先读取环境变量，Streamlit Cloud 上回退到 secrets；每个会话只解析一次
+deepseek_api_key = st.session_state.get("deepseek_api_key")
+if not deepseek_api_key:
+    logger.debug("尝试获取 DeepSeek API 密钥...")
+    deepseek_api_key = (
+        os.getenv("DEEPSEEK_API_KEY")
+        or os.getenv("DEEPSEEK_KEY")
+        or st.secrets.get("DEEPSEEK_KEY")
+    )
+    # 只缓存找到的密钥，未找到时下次重跑会重新查找
+    if deepseek_api_key:
+        st.session_state["deepseek_api_key"] = deepseek_api_key
 
 if not deepseek_api_key:
-    st.error("未找到 DeepSeek API 密钥，请检查 Streamlit Secrets 设置")
+    st.error("未找到 DeepSeek API 密钥，请检查环境变量或 Streamlit Secrets 设置")
     st.stop()
 else:
-    print(f"[DEBUG] 从 Streamlit Secrets 获取密钥: {deepseek_api_key[:4]}...")
+    logger.debug("已获取 API 密钥: %s...", deepseek_api_key[:4])
 
 # -------------------- DeepSeek API 配置 --------------------
 DEEPSEEK_API_URL = "https://api.deepseek.com/v1"
@@ -54,55 +77,82 @@ with st.sidebar:
     st.divider()
     st.header("API设置")
     
-    st.success(f"✅ API 密钥已通过 Streamlit Secrets 获取")
+    st.success("✅ API 密钥已获取")
     st.info(f"当前模型: {MODEL_NAME}")
     
-    # 使用按钮代替 link_button
-    if st.button("🌐 检查 DeepSeek 状态", key="status_check_button"):
-        webbrowser.open_new_tab("https://platform.deepseek.com/api")
-        st.toast("已在浏览器中打开 DeepSeek API 文档")
+    # 链接在用户浏览器中打开，而不是在服务器上
+    st.link_button("🌐 检查 DeepSeek 状态", "https://platform.deepseek.com/api")
     
     # 添加 Streamlit Cloud 说明
     st.divider()
     st.markdown("""
         **Streamlit Cloud 说明:**
-        1. API 密钥通过 Secrets 管理
+        1. API 密钥通过环境变量或 Secrets 管理
         2. 所有数据文件必须上传到 GitHub
         3. 文件路径已适配云端环境
     """)
 
+def _parse_sse_line(line):
+    """解析一行 SSE 数据，返回其中的增量文本（无内容时返回 None）"""
+    if not line.startswith("data:"):
+        return None
+    data = line[len("data:"):].strip()
+    if data == "[DONE]":
+        return None
+    choices = json.loads(data).get("choices") or []
+    if not choices:
+        return None
+    return choices[0].get("delta", {}).get("content")
+
 # 创建 DeepSeek API 客户端
 class DeepSeekClient:
-    def __init__(self, api_key, base_url=DEEPSEEK_API_URL):
+    def __init__(self, api_key, base_url=DEEPSEEK_API_URL, model=MODEL_NAME):
         self.api_key = api_key
         self.base_url = base_url
         self.headers = {
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         }
-        print(f"[DEBUG] 使用 API 密钥: {api_key[:4]}...")
+        # 请求体中固定不变的部分
+        self._base_payload = {"model": model}
+        # 复用同一个连接池（含 base_url 与请求头），避免每次请求都重新建立 TCP/TLS 连接；
+        # 连接失败由 transport 层自动重试
+        self._http = httpx.Client(
+            base_url=base_url,
+            headers=self.headers,
+            timeout=httpx.Timeout(60.0, connect=5.0),
+            transport=httpx.HTTPTransport(http2=True, retries=2)
+        )
+        atexit.register(self.close)
+        logger.debug("使用 API 密钥: %s...", api_key[:4])
+
+    def close(self):
+        """关闭底层 HTTP 连接池"""
+        self._http.close()
     
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=2, max=20),
-        retry=retry_if_exception_type((httpx.ConnectError, httpx.TimeoutException))
-    )
-    def chat_completions(self, model, messages, temperature=0.7, max_tokens=2000):
-        """调用 DeepSeek 聊天完成 API"""
-        url = f"{self.base_url}/chat/completions"
+    def stream_chat(self, messages, model=None, temperature=0.7, max_tokens=2000):
+        """以流式方式调用 DeepSeek 聊天完成 API，逐段返回生成的文本"""
         payload = {
-            "model": model,
+            **self._base_payload,
             "messages": messages,
             "temperature": temperature,
-            "max_tokens": max_tokens
+            "max_tokens": max_tokens,
+            "stream": True
         }
-        
+        if model:
+            payload["model"] = model
+
         try:
-            print(f"[DEBUG] 发送请求到: {url}")
-            with httpx.Client(timeout=60.0) as client:
-                response = client.post(url, headers=self.headers, json=payload)
+            logger.debug("发送流式请求到: %s/chat/completions", self.base_url)
+            with self._http.stream("POST", "/chat/completions", json=payload) as response:
+                if response.is_error:
+                    # 读取完整错误响应体，便于下方展示
+                    response.read()
                 response.raise_for_status()
-                return response.json()
+                for line in response.iter_lines():
+                    content = _parse_sse_line(line)
+                    if content:
+                        yield content
         except httpx.HTTPStatusError as e:
             st.error(f"API 请求失败: HTTP {e.response.status_code}")
             st.json(e.response.json())
@@ -111,74 +161,62 @@ class DeepSeekClient:
             st.error(f"网络连接错误: {str(e)}")
             raise
 
+@st.cache_resource
+def get_client(api_key: str) -> DeepSeekClient:
+    """创建并缓存 DeepSeek 客户端（跨重跑、跨会话共享）"""
+    return DeepSeekClient(api_key)
+
 # 创建客户端实例
-client = DeepSeekClient(api_key=deepseek_api_key)
-
-# 测试 API 连接
-try:
-    print("[DEBUG] 测试 API 连接...")
-    test_response = client.chat_completions(
-        model=MODEL_NAME,
-        messages=[{"role": "user", "content": "测试连接，请回复'连接成功'"}],
-        max_tokens=10
-    )
-    if 'choices' in test_response and len(test_response['choices']) > 0:
-        test_message = test_response['choices'][0]['message']['content']
-        print(f"[DEBUG] API 连接测试成功: {test_message}")
-        st.sidebar.success("✅ 连接测试成功")
-    else:
-        st.sidebar.error("❌ API 响应格式异常")
-        st.sidebar.json(test_response)
-except Exception as e:
-    st.sidebar.error(f"❌ 连接测试失败: {str(e)}")
-    st.sidebar.warning("请检查 API 密钥和网络连接")
+client = get_client(deepseek_api_key)
 
 # -------------------- 数据加载与预处理 --------------------
-def clean_text(text):
-    """清理文本中的非法字符"""
-    if isinstance(text, str):
-        return text.encode('utf-8', 'ignore').decode('utf-8')
-    return text
-
-def load_and_preprocess_data():
-    """加载并预处理景点、美食、文化数据"""
+@st.cache_data(show_spinner="加载数据…")
+def load_and_preprocess_data(attractions_path: str, food_path: str, culture_path: str):
+    """加载并预处理景点、美食、文化数据（按文件路径缓存，避免每次重跑都重新读取 CSV）"""
     try:
-        print("[DEBUG] 加载景点数据...")
+        logger.debug("加载景点数据...")
         # 景点数据
         attractions = pd.read_csv(
             attractions_path,
-            encoding="utf-8-sig",
-            engine="python",
-            on_bad_lines="warn"
+            encoding="utf-8",
+            engine="pyarrow",
+            dtype_backend="pyarrow",
+            usecols=["名称", "景点特色说明"]
         )
-        attractions.columns = [clean_text(col) for col in attractions.columns]
-        attractions = attractions.applymap(clean_text)
-        attractions["景点特色说明"] = attractions["景点特色说明"].fillna("暂无特色说明").astype(str)
+        attractions["景点特色说明"] = attractions["景点特色说明"].fillna("暂无特色说明")
         
-        print("[DEBUG] 加载美食数据...")
+        logger.debug("加载美食数据...")
         # 美食数据
         foods = pd.read_csv(
             food_path,
-            encoding="utf-8-sig",
-            engine="python",
-            on_bad_lines="warn"
+            encoding="utf-8",
+            engine="pyarrow",
+            dtype_backend="pyarrow",
+            usecols=["店名", "人均消费"]
         )
-        foods.columns = [clean_text(col) for col in foods.columns]
-        foods = foods.applymap(clean_text)
-        foods["特色菜"] = foods["特色菜"].fillna("暂无推荐菜")
         
-        print("[DEBUG] 加载文化数据...")
+        logger.debug("加载文化数据...")
         # 文化数据
         culture = pd.read_csv(
             culture_path,
-            encoding="utf-8-sig",
-            engine="python",
-            on_bad_lines="warn"
+            encoding="utf-8",
+            engine="pyarrow",
+            dtype_backend="pyarrow",
+            usecols=["名称"]
         )
-        culture.columns = [clean_text(col) for col in culture.columns]
-        culture = culture.applymap(clean_text)
-        
-        return attractions, foods, culture
+
+        # 预先格式化提示词片段，点击生成时只需抽样拼接
+        attraction_strings = [
+            f"{name}（{desc}）"
+            for name, desc in zip(attractions["名称"], attractions["景点特色说明"])
+        ]
+        food_strings = [
+            f"{name}（人均{cost}元）"
+            for name, cost in zip(foods["店名"], foods["人均消费"])
+        ]
+        culture_names = culture["名称"].tolist()
+
+        return attraction_strings, food_strings, culture_names
 
     except Exception as e:
         st.error(f"数据加载失败：{str(e)}")
@@ -189,24 +227,26 @@ def load_and_preprocess_data():
         st.stop()
 
 # 加载数据
-attractions, foods, culture = load_and_preprocess_data()
+attraction_strings, food_strings, culture_names = load_and_preprocess_data(
+    str(attractions_path), str(food_path), str(culture_path)
+)
 
 # 数据完整性检查
-if len(attractions) == 0:
+if len(attraction_strings) == 0:
     st.error("景点数据为空，请检查数据文件！")
     st.stop()
 
-if len(foods) == 0:
+if len(food_strings) == 0:
     st.error("美食数据为空，请检查数据文件！")
     st.stop()
 
-print(f"[DEBUG] 景点记录数：{len(attractions)}")
-print(f"[DEBUG] 美食记录数：{len(foods)}")
-print(f"[DEBUG] 文化记录数：{len(culture)}")
+logger.debug("景点记录数：%d", len(attraction_strings))
+logger.debug("美食记录数：%d", len(food_strings))
+logger.debug("文化记录数：%d", len(culture_names))
 
 # -------------------- Streamlit 界面设计 --------------------
-st.title("🚩 韶关个性化旅游攻略生成器")
-st.markdown("""
+# 主题色见 .streamlit/config.toml，这里只保留主题无法覆盖的样式
+_CSS = """
     <style>
     /* 主按钮样式 */
     .stButton>button {
@@ -225,56 +265,37 @@ st.markdown("""
         transition: transform 0.2s;
     }
     
-    /* 状态按钮样式 */
-    .status-button {
-        background-color: #2196F3 !important;
-    }
-    
     /* 错误信息样式 */
     .stAlert {
         border-left: 4px solid #ff4b4b;
         padding: 1rem;
         margin: 1rem 0;
     }
-    
-    /* 侧边栏样式 */
-    .sidebar .sidebar-content {
-        background-color: #f8f9fa;
-        padding: 20px;
-        border-radius: 10px;
-        box-shadow: 0 4px 6px rgba(0,0,0,0.1);
-    }
     </style>
-""", unsafe_allow_html=True)
+"""
+
+st.title("🚩 韶关个性化旅游攻略生成器")
+st.markdown(_CSS, unsafe_allow_html=True)
 
 # -------------------- 动态生成提示词 --------------------
+@st.cache_resource
+def _load_template(path: str) -> str:
+    """读取提示词模板（每个进程只读取一次）"""
+    return Path(path).read_text(encoding="utf-8")
+
 def build_prompt(days, budget, interest):
     """构建 DeepSeek 提示词模板"""
     try:
-        print("[DEBUG] 构建提示词...")
-        template_path = current_dir / "prompt_template.txt"
-        with open(template_path, "r", encoding="utf-8") as f:
-            template = f.read()
-
-        # 安全抽样景点（最多3个）
-        sample_size = min(3, len(attractions))
-        sampled_attractions = attractions.sample(sample_size) if sample_size > 0 else attractions
-        attractions_info = [
-            f"{row['名称']}（{row.get('景点特色说明', '暂无说明')}" 
-            for _, row in sampled_attractions.iterrows()
-        ]
+        logger.debug("构建提示词...")
+        template = _load_template(str(current_dir / "prompt_template.txt"))
 
-        # 安全抽样餐厅（最多2个）
-        sample_size = min(2, len(foods))
-        sampled_foods = foods.sample(sample_size) if sample_size > 0 else foods
-        food_info = [
-            f"{row['店名']}（人均{row.get('人均消费', '?')}元）"
-            for _, row in sampled_foods.iterrows()
-        ]
+        # 安全抽样景点（最多3个）、餐厅（最多2个）
+        attractions_info = random.sample(attraction_strings, min(3, len(attraction_strings)))
+        food_info = random.sample(food_strings, min(2, len(food_strings)))
 
         # 安全处理文化体验
-        if len(culture) > 0:
-            cultural_activity = culture.sample(1).iloc[0]["名称"]
+        if len(culture_names) > 0:
+            cultural_activity = random.choice(culture_names)
         else:
             cultural_activity = "自由探索当地文化"
 
@@ -292,36 +313,65 @@ def build_prompt(days, budget, interest):
         st.stop()
 
 # -------------------- 生成攻略逻辑 --------------------
-def get_ai_response(prompt):
-    """调用 DeepSeek API 获取响应"""
+@st.cache_resource
+def _itinerary_cache():
+    """跨会话共享的攻略缓存（最多 128 条，1 小时过期）及保护它的锁"""
+    return TTLCache(maxsize=128, ttl=3600), threading.Lock()
+
+def stream_ai_response(prompt):
+    """流式调用 DeepSeek API，逐段返回攻略文本"""
     try:
-        print("[DEBUG] 调用 DeepSeek API...")
-        response = client.chat_completions(
+        logger.debug("调用 DeepSeek API...")
+        yield from client.stream_chat(
             model=MODEL_NAME,
             messages=[{"role": "user", "content": prompt}],
             temperature=0.7,
             max_tokens=4000
         )
-        return response
     except Exception as e:
-        print(f"[ERROR] API 调用失败: {str(e)}")
+        logger.error("API 调用失败: %s", e)
         raise
 
-if st.button("✨ 一键生成攻略", key="generate_button"):
+col_generate, col_regenerate = st.columns([3, 1])
+generate = col_generate.button("✨ 一键生成攻略", key="generate_button")
+regenerate = col_regenerate.button(
+    "🔄 重新生成",
+    key="regenerate_button",
+    help="跳过缓存，重新抽样景点与餐厅并生成新攻略"
+)
+
+if generate or regenerate:
     with st.spinner("AI 正在规划行程..."):
         try:
-            prompt = build_prompt(days, budget, interest)
-            print("[DEBUG] 生成的提示词：\n", prompt)
+            # 相同的天数、预算与主题在一小时内直接复用已生成的攻略；
+            # 提示词含随机抽样，因此不能作为缓存键。「重新生成」跳过查找并覆盖缓存
+            itineraries, itineraries_lock = _itinerary_cache()
+            cache_key = (days, budget, interest)
+            itinerary = None
+            from_cache = False
+            if not regenerate:
+                with itineraries_lock:
+                    itinerary = itineraries.get(cache_key)
+                from_cache = bool(itinerary)
             
-            start_time = time.time()
-            response = get_ai_response(prompt)
-            elapsed = time.time() - start_time
-            print(f"[DEBUG] API 响应时间: {elapsed:.2f} 秒")
-            
-            if 'choices' in response and len(response['choices']) > 0:
-                itinerary = response['choices'][0]['message']['content']
-                st.success("✅ 攻略生成成功！")
+            if from_cache:
+                st.info("ℹ️ 以下是相同参数在一小时内生成过的攻略，点击「🔄 重新生成」可获取新的推荐")
                 st.markdown(itinerary)
+            else:
+                prompt = build_prompt(days, budget, interest)
+                logger.debug("生成的提示词：\n%s", prompt)
+                
+                start_time = time.time()
+                itinerary = st.write_stream(stream_ai_response(prompt))
+                elapsed = time.time() - start_time
+                logger.debug("API 响应时间: %.2f 秒", elapsed)
+                if itinerary:
+                    with itineraries_lock:
+                        itineraries[cache_key] = itinerary
+            
+            if itinerary:
+                if not from_cache:
+                    st.success("✅ 攻略生成成功！")
                 
                 # 添加下载按钮
                 st.download_button(
@@ -333,7 +383,6 @@ if st.button("✨ 一键生成攻略", key="generate_button"):
                 )
             else:
                 st.error("API 响应格式异常，无法获取攻略内容")
-                st.json(response)  # 显示原始响应用于调试
             
         except Exception as e:
             st.error(f"生成失败：{str(e)}")
@@ -344,16 +393,20 @@ if st.button("✨ 一键生成攻略", key="generate_button"):
                 3. 稍后再试（API 服务可能暂时不可用）
             """)
             
-            if st.button("🌐 检查 DeepSeek 状态", key="status_button", help="点击在浏览器中打开 DeepSeek API 文档"):
-                webbrowser.open_new_tab("https://platform.deepseek.com/api")
-                st.toast("已在浏览器中打开 DeepSeek API 文档")
+            st.link_button(
+                "🌐 检查 DeepSeek 状态",
+                "https://platform.deepseek.com/api",
+                help="点击在浏览器中打开 DeepSeek API 文档"
+            )
 
 # -------------------- 调试信息 --------------------
-# 添加文件路径显示
+# 仅在打开调试模式时显示文件路径
 st.sidebar.divider()
-st.sidebar.subheader("调试信息")
-st.sidebar.write(f"当前目录: {current_dir}")
-st.sidebar.write(f"数据目录: {data_dir}")
+debug = st.sidebar.toggle("调试模式", value=False, key="debug")
+if debug:
+    with st.sidebar.expander("调试信息", expanded=False):
+        st.write(f"当前目录: {current_dir}")
+        st.write(f"数据目录: {data_dir}")
 
 # 添加页脚
 st.divider()